@@ -1,9 +1,10 @@
 import streamlit as st
-import datetime as dt
 import pandas as pd
 import asyncio
+import threading
 
-from env_canada import ECWeather, ECHistorical
+import aiohttp
+from env_canada import ECWeather, ECHistorical, ECWeatherUpdateFailed
 from env_canada.ec_historical import get_historical_stations
 
 # https://dd.weather.gc.ca/observations/xml/PE/yesterday/yesterday_pe_20240208_e.xml
@@ -12,14 +13,29 @@ from env_canada.ec_historical import get_historical_stations
 WEATHER_SITES_URL = 'https://dd.weather.gc.ca/citypage_weather/docs/site_list_provinces_en.csv'
 WEATHER_URL = 'https://dd.weather.gc.ca/citypage_weather/xml/PE/s0000026_e.xml'
 
-@st.cache_data
+# Keep requests to Environment Canada polite under repeated refreshes
+EC_MAX_CONCURRENT_REQUESTS = 4
+EC_MAX_ATTEMPTS = 3
+
+@st.cache_data(ttl=60*60*24, show_spinner=False)
 def load_sites_data():
     """Loads weather sites from Environment Canada's most recent sites list
 
     Returns:
         DataFrame: a pandas DataFrame containing site codes, names, and lat/long
     """
-    data = pd.read_csv(WEATHER_SITES_URL, header=1)
+    data = pd.read_csv(
+        WEATHER_SITES_URL,
+        header=1,
+        usecols=['Codes', 'English Names', 'Province Codes', 'Latitude', 'Longitude'],
+        dtype={
+            'Codes': 'string',
+            'English Names': 'category',
+            'Province Codes': 'category',
+            'Latitude': 'string',
+            'Longitude': 'string',
+        },
+    )
     lowercase = lambda x: str(x).lower()
     data.rename(lowercase, axis='columns', inplace=True)
     
@@ -30,17 +46,21 @@ def load_sites_data():
     return data
 
 
-def split_date_range(range_col):
-    """Splits a column that contains a `start_date | end_date` string into separate columns
-
-    Args:
-        range_col (Series): A DataFrame column to split
+@st.cache_resource(ttl=60*60*24, show_spinner=False)
+def load_sites_by_province():
+    """Groups the weather sites list by province, so that the app can look up a province's sites
+    without scanning the whole list.  Cached as a shared resource so reruns don't copy it;
+    the returned frames must be treated as read-only.
 
     Returns:
-        Series: Two new columns with dates separated
+        dict: province code -> DataFrame of that province's sites
     """
+    data = load_sites_data()
     
-    return pd.Series(range_col.split('|', 1))
+    return {
+        province: sites.reset_index(drop=True)
+        for province, sites in data.groupby('province codes', observed=True)
+    }
 
 
 def process_station_dates(df):
@@ -54,10 +74,13 @@ def process_station_dates(df):
     Returns:
         DataFrame: Returns a transformed DataFrame with separated start / end columns, as datetimes.
     """
-    df = df.T
-    df[['hourly_data_start', 'hourly_data_end']] = df['hlyRange'].apply(split_date_range)
-    df[['daily_data_start', 'daily_data_end']] = df['dlyRange'].apply(split_date_range)
-    df[['monthly_data_start', 'monthly_data_end']] = df['mlyRange'].apply(split_date_range)
+    # drop returns a new frame, so the columns added below don't modify the caller's DataFrame
+    ranges = df[['hlyRange', 'dlyRange', 'mlyRange']]
+    df = df.drop(columns=ranges.columns)
+    
+    df[['hourly_data_start', 'hourly_data_end']] = ranges['hlyRange'].str.split('|', n=1, expand=True)
+    df[['daily_data_start', 'daily_data_end']] = ranges['dlyRange'].str.split('|', n=1, expand=True)
+    df[['monthly_data_start', 'monthly_data_end']] = ranges['mlyRange'].str.split('|', n=1, expand=True)
     
     cols_to_process = [
         'hourly_data_start',
@@ -68,10 +91,9 @@ def process_station_dates(df):
         'monthly_data_end',
     ]
     
-    for col in cols_to_process:
-        df[col] = pd.to_datetime(df[col], format='%Y-%m-%d')
-    
-    df = df.drop(columns=['hlyRange', 'dlyRange', 'mlyRange'])
+    # parse all six columns in one call; cache=True reuses results for repeated dates
+    dates = pd.to_datetime(pd.Series(df[cols_to_process].to_numpy().ravel()), format='%Y-%m-%d', cache=True)
+    df[cols_to_process] = dates.to_numpy().reshape(len(df), len(cols_to_process))
     
     return df
 
@@ -86,16 +108,32 @@ def choose_historical_station_id(df):
         df: A single station row that contains the most recent daily data
     """
     # filter only those that have daily data
-    selected_stations = df[df['daily_data_end'] == dt.datetime.strftime((dt.datetime.today() - dt.timedelta(days=1)), format='%Y-%m-%d')]
-    selected_stations = selected_stations.sort_values(by='proximity', ascending=True)
+    yesterday = pd.Timestamp.today().normalize() - pd.Timedelta(days=1)
+    selected_stations = df[df['daily_data_end'] == yesterday]
     try:
-        selected_station = selected_stations['id'].iloc[0]
+        selected_station = selected_stations.nsmallest(1, 'proximity')['id'].iat[0]
     except IndexError:
         return pd.DataFrame({'id': 1234, 'proximity': 1234, 'prov': 'AB', 'hlyRange':'|', 'dlyRange':'|', 'mlyRange':'|'})
     return selected_station
 
     
-def get_conditions(station_id):
+@st.cache_resource(max_entries=16)
+def get_weather_client(station_id):
+    """Creates a reusable current conditions client for a given weather station.  The client
+    resolves its station against the sites list once, so later updates skip that download.
+    Each client keeps its own copy of the full sites list, so only a few are kept.
+
+    Args:
+        station_id (String): Must be in the format `Province Code`/`Station Code`.
+
+    Returns:
+        ECWeather: A client whose `update` refreshes its conditions in place
+    """
+    
+    return ECWeather(station_id=station_id, language='english')
+
+
+async def get_conditions(station_id):
     """Retrieves the latest weather conditions from a given weather station.
 
     Args:
@@ -105,8 +143,12 @@ def get_conditions(station_id):
         dict: Dictionary containing the latest weather conditions.
     """
     # station_id='ON/s0000430'
-    weather = ECWeather(station_id=station_id, language='english')
-    asyncio.run(weather.update())
+    weather = get_weather_client(station_id)
+    await ec_request(weather.update)
+    
+    # a client with recent data keeps its old conditions on a failed update instead of raising
+    if weather.metadata.last_update_error:
+        raise ECWeatherUpdateFailed(weather.metadata.last_update_error)
     
     return weather.conditions
 
@@ -121,23 +163,16 @@ def format_conditions_data(conditions_data):
         df: A DataFrame with reordered columns for readability
     """
     
-    df = pd.DataFrame()
-    df['label'] = conditions_data['label']
-    df['value'] = conditions_data['value']
-    df['unit'] = conditions_data['unit']
-    
-    return df
+    return conditions_data.loc[:, ['label', 'value', 'unit']]
     
     
-def display_conditions(station):
-    """Retrieves current weather conditions from a given station site.
+def display_conditions(conditions):
+    """Formats current weather conditions and stores them for display.
 
     Args:
-        station (DataFrame): A single station site row, as output from load_sites_data
+        conditions (dict): Weather conditions, as output from get_conditions
     """
     
-    station_id = f"{station['province codes'].values[0]}/{station['codes'].values[0]}"
-    conditions = get_conditions(station_id)
     conditions_data = pd.DataFrame.from_dict(conditions).T
     conditions_data = format_conditions_data(conditions_data)
     
@@ -145,16 +180,13 @@ def display_conditions(station):
     st.session_state.conditions = conditions_data
 
     
-def display_historical(station_id):
-    """Retrieves historical weather data from a given station site row, as output from load_sites_data.
-    Updates display, including station site metadata.
+def display_historical(metadata, history):
+    """Stores historical weather data and station site metadata for display.
 
     Args:
-        station_id (DataFrame): A single station site row, as output from load_sites_data
+        metadata (dict): Historical station metadata, as output from get_historical_data
+        history (DataFrame): Historical weather data, as output from get_historical_data
     """
-    station_coords = (station['latitude'].values[0], station['longitude'].values[0])
-    station_id = lookup_stations(station_coords, radius=25, limit=10)
-    metadata, history = get_historical_data(station_id)
     
     # Update session state
     st.session_state.history = history
@@ -163,6 +195,7 @@ def display_historical(station_id):
     st.session_state.stn_location = (float(metadata['latitude']), float(metadata['longitude']))
 
 
+@st.cache_data(ttl=60*60*24, max_entries=256, show_spinner=False)
 def lookup_stations(coordinates, radius, limit):
     """Retrieves the closest weather station site to the provided coordinates that has daily data.
 
@@ -174,14 +207,15 @@ def lookup_stations(coordinates, radius, limit):
     Returns:
         int: The historical station ID for the retrieved station.
     """
-    stations = asyncio.run(get_historical_stations(coordinates, radius=radius, limit=limit))
-    stations_df = pd.DataFrame.from_dict(stations)
+    stations = run_async(ec_request(lambda: get_historical_stations(coordinates, radius=radius, limit=limit)))
+    stations_df = pd.DataFrame.from_dict(stations, orient='index')
     stations_df = process_station_dates(stations_df)
     station_id = choose_historical_station_id(stations_df)
 
     return int(station_id)
 
     
+@st.cache_data(ttl=3600, max_entries=64, show_spinner=False)
 def get_historical_data(station_id):
     """Retrieves historical station metadata and weather data from a given historical station ID.
 
@@ -193,13 +227,133 @@ def get_historical_data(station_id):
     """
 
     ec_en_csv = ECHistorical(station_id=station_id, year=2024, language='english', format='csv')
-    asyncio.run(ec_en_csv.update())
+    run_async(ec_request(ec_en_csv.update))
 
     metadata = ec_en_csv.metadata
     df = pd.read_csv(ec_en_csv.station_data)
 
     
     return metadata, df
+
+
+async def _get_history_async(coordinates):
+    """Looks up the closest historical station to the coordinates, then retrieves its data.
+    The two requests depend on each other, so they run one after the other.
+
+    Args:
+        coordinates (tuple): Latitude and longitude, formatted as a tuple
+
+    Returns:
+        dict, df: metadata about the station, and a dataframe that contains the historical weather information
+    """
+    # lookup_stations and get_historical_data are cached and blocking, so run them off the event loop
+    station_id = await asyncio.to_thread(lookup_stations, coordinates, radius=25, limit=10)
+    
+    return await asyncio.to_thread(get_historical_data, station_id)
+
+
+async def _fetch_all(station_id, coordinates):
+    """Retrieves current conditions and historical data concurrently.
+
+    Args:
+        station_id (String): Must be in the format `Province Code`/`Station Code`.
+        coordinates (tuple): Latitude and longitude, formatted as a tuple
+
+    Returns:
+        dict, (dict, df): current conditions, and the historical metadata and data
+    """
+    
+    return await asyncio.gather(get_conditions(station_id), _get_history_async(coordinates))
+
+
+@st.cache_resource
+def get_loop():
+    """Starts a single background event loop shared by all sessions, so that each request
+    does not pay for building and tearing down its own loop.  The semaphore bounding
+    concurrent requests to Environment Canada is created with it, as it binds to this loop.
+
+    Returns:
+        AbstractEventLoop, Semaphore: A running event loop on a daemon thread, and a semaphore
+        allowing EC_MAX_CONCURRENT_REQUESTS requests at once
+    """
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, daemon=True).start()
+    semaphore = asyncio.Semaphore(EC_MAX_CONCURRENT_REQUESTS)
+    
+    return loop, semaphore
+
+
+def run_async(coro):
+    """Runs a coroutine on the shared background event loop and waits for its result.
+
+    Args:
+        coro (coroutine): The coroutine to run
+
+    Returns:
+        object: The value returned by the coroutine
+    """
+    loop, _ = get_loop()
+    future = asyncio.run_coroutine_threadsafe(coro, loop)
+    
+    return future.result()
+
+
+def is_transient_error(err):
+    """Checks whether a failed request to Environment Canada is worth retrying.
+
+    Args:
+        err (Exception): The error raised by the request
+
+    Returns:
+        bool: True for rate limiting, server errors, connection errors and timeouts
+    """
+    if isinstance(err, ECWeatherUpdateFailed):
+        # ECWeather wraps the underlying request error
+        return is_transient_error(err.__cause__)
+    if isinstance(err, aiohttp.ClientResponseError):
+        return err.status == 429 or err.status >= 500
+    
+    return isinstance(err, (aiohttp.ClientError, asyncio.TimeoutError))
+
+
+async def ec_request(request):
+    """Runs a request to Environment Canada with bounded concurrency, retrying transient failures
+    with exponential backoff.  ECWeather handles request errors itself and returns its previous
+    conditions while they are recent, so only its `ECWeatherUpdateFailed` errors can be retried.
+
+    Args:
+        request (callable): Returns a new coroutine making the request each time it is called
+
+    Returns:
+        object: The value returned by the request coroutine
+    """
+    _, semaphore = get_loop()
+    for attempt in range(EC_MAX_ATTEMPTS):
+        try:
+            async with semaphore:
+                return await request()
+        except (aiohttp.ClientError, asyncio.TimeoutError, ECWeatherUpdateFailed) as err:
+            if attempt == EC_MAX_ATTEMPTS - 1 or not is_transient_error(err):
+                raise
+        # back off outside the semaphore so waiting retries don't hold a slot
+        await asyncio.sleep(2 ** attempt)
+
+
+@st.cache_data(ttl=600, max_entries=128, show_spinner=False)
+def fetch_station_data(station_id, coordinates):
+    """Retrieves current conditions and historical data for a station site in a single event loop.
+    Cached for 10 minutes to keep conditions fresh; historical data has its own hourly cache.
+
+    Args:
+        station_id (String): Must be in the format `Province Code`/`Station Code`.
+        coordinates (tuple): Latitude and longitude, formatted as a tuple
+
+    Returns:
+        dict, (dict, df): current conditions, and the historical metadata and data
+    """
+    conditions, history = run_async(_fetch_all(station_id, coordinates))
+    
+    return conditions, history
     
     
 def update_displays(station):
@@ -210,8 +364,46 @@ def update_displays(station):
         provided by load_sites_data.
     """
     
-    display_conditions(station)
-    display_historical(station)
+    station_id = f"{station['province codes'].iat[0]}/{station['codes'].iat[0]}"
+    station_coords = (float(station['latitude'].iat[0]), float(station['longitude'].iat[0]))
+    conditions, (metadata, history) = fetch_station_data(station_id, station_coords)
+    
+    display_conditions(conditions)
+    display_historical(metadata, history)
+
+
+@st.fragment
+def _refresh_panel(station):
+    """Displays current conditions and historical data for a station, with a button to refresh them.
+    Runs as a fragment, so refreshing only reruns this panel rather than the whole app.
+
+    Args:
+        station (DataFrame): A single DataFrame row that contains weather station information
+        provided by load_sites_data.
+    """
+    
+    st.subheader('Current Conditions')
+    st.dataframe(st.session_state.conditions, use_container_width=True)
+    
+    st.subheader('Historical Data')
+    
+    col1, col2, col3 = st.columns(3)
+    
+    col1.caption('Station Name')
+    col1.text(st.session_state.stn_name)
+    col2.caption('Climate Identifier')
+    col2.text(st.session_state.stn_identifier)
+    col3.caption('Station Location')
+    col3.text(st.session_state.stn_location)
+    
+    st.warning('Use the Refresh Data button below to update this section.  Displays daily historical data closest to your chosen station.', icon='⚠️')
+    
+    st.dataframe(st.session_state.history, use_container_width=True)
+    
+    st.button('Refresh Data',
+              on_click=update_displays,
+              args=(station,),
+              )
 
 
 
@@ -223,14 +415,14 @@ st.sidebar.header('Canadian Weather Stations')
 with st.spinner('Loading data...'):
 # Load available WEATHER_SITES
     data_load_state = st.text('Loading data...')
-    station_data = load_sites_data()
+    sites_by_province = load_sites_by_province()
     data_load_state.text('')
 
 
 provinces = ['AB', 'BC', 'MB', 'NB', 'NL', 'NS', 'NT', 'NU', 'ON', 'PE', 'QC', 'SK', 'YT']
 
 province_to_filter = st.sidebar.selectbox('Choose a province', provinces)
-filtered_data = station_data[station_data['province codes'] == province_to_filter]
+filtered_data = sites_by_province[province_to_filter]
 
 st.subheader(f'Locations of all stations in {province_to_filter}')
 st.map(filtered_data)
@@ -240,17 +432,8 @@ station = filtered_data[filtered_data['english names'] == stations_to_filter]
 
 if 'conditions' not in st.session_state:
     st.session_state.conditions = pd.DataFrame()
-    
-conditions_output_box = st.subheader('Current Conditions')
-conditions_output_df = st.dataframe(st.session_state.conditions, use_container_width=True)
-
 if 'history' not in st.session_state:
     st.session_state.history = pd.DataFrame()
-    
-history_output_box = st.subheader('Historical Data')
-
-col1, col2, col3 = st.columns(3)
-
 if 'stn_name' not in st.session_state:
     st.session_state.stn_name = ''
 if 'stn_identifier' not in st.session_state:
@@ -258,18 +441,4 @@ if 'stn_identifier' not in st.session_state:
 if 'stn_location' not in st.session_state:
     st.session_state.stn_location = ''
 
-
-col1.caption('Station Name')
-col1.text(st.session_state.stn_name)
-col2.caption('Climate Identifier')
-col2.text(st.session_state.stn_identifier)
-col3.caption('Station Location')
-col3.text(st.session_state.stn_location)
-
-st.warning('Use the Refresh Data button on the sidebar to update this section.  Displays daily historical data closest to your chosen station.', icon='⚠️')
-
-history_output_df = st.dataframe(st.session_state.history, use_container_width=True)
-
-st.sidebar.button('Refresh Data',
-                  on_click=update_displays(station),
-                  )
\ No newline at end of file
+_refresh_panel(station)